@@ -1,27 +1,51 @@
 import argparse
+import base64
+import bisect
 import datetime
+import email.utils
 import hashlib
+import heapq
 import json
 import logging
 import os.path
+import pickle
+import random
 import re
-import shutil
+import sqlite3
 import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from enum import Enum
 from pathlib import Path
-from typing import ClassVar, Self, Callable, Any
+from typing import ClassVar, Self, Callable, Any, Iterator
 from urllib.parse import urlparse
 
 import yaml
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, PrivateAttr, validator
 from pydantic.networks import HttpUrl
-from requests import Request, Session, PreparedRequest
+from requests import HTTPError, Request, RequestException, Response, Session, PreparedRequest
+from requests.exceptions import ChunkedEncodingError, ConnectionError as RequestConnectionError, SSLError, Timeout
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class AppError(Exception):
     pass
 
 
+class TransientError(AppError):
+    pass
+
+
 def get_hash_file_digest(hash_file: Path) -> str:
     logging.debug(f'Loading digest from {hash_file}')
     try:
@@ -41,16 +65,176 @@ def get_file_digest(target_file: Path, algorithm: str) -> str:
         raise AppError(f'Failed to compute hash for {target_file}: {e}')
 
 
-def is_digest_valid(target_file: Path, hash_file: Path) -> bool:
-    logging.debug(f'Checking {target_file} against {hash_file}')
-    fingerprint = get_hash_file_digest(hash_file)
-    extension = hash_file.suffix.lower()
+def get_digest_algorithm(hash_file_name: str) -> str:
+    extension = Path(hash_file_name).suffix.lower()
     if extension.startswith('.'):
         extension = extension[1:]
-    computed = get_file_digest(target_file, extension)
+    return extension
+
+
+def is_digest_valid(target_file: Path, hash_file: Path, computed: str = None) -> bool:
+    logging.debug(f'Checking {target_file} against {hash_file}')
+    fingerprint = get_hash_file_digest(hash_file)
+    if computed is None:
+        computed = get_file_digest(target_file, get_digest_algorithm(hash_file.name))
+    else:
+        logging.debug(f'Using already known digest for {target_file}')
     return computed == fingerprint
 
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+
+def non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f'{value} is not a non-negative integer')
+    return number
+
+
+def host_pool(value: str) -> tuple[str, int]:
+    hostname, _, size = value.partition('=')
+    if not hostname or not size:
+        raise argparse.ArgumentTypeError(f'{value} is not in the HOST=SIZE format')
+    return hostname.lower(), positive_int(size)
+
+
+class KeyedLock:
+
+    def __init__(self) -> None:
+        self.guard = threading.Lock()
+        self.locks: dict[str, threading.Lock] = {}
+
+    @contextmanager
+    def hold(self, key: str):
+        with self.guard:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            yield
+
+
+class SingleFlight:
+
+    def __init__(self) -> None:
+        self.guard = threading.Lock()
+        self.flights: dict[str, Future] = {}
+
+    def do(self, key: str, function: Callable[[], Any]) -> Any:
+        with self.guard:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Future()
+        if not leader:
+            return flight.result()
+        try:
+            result = function()
+            flight.set_result(result)
+            return result
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self.guard:
+                del self.flights[key]
+
+
+class RetryPolicy:
+    RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+    MAX_DELAY = 60
+
+    def __init__(self, retries: int = 3, host_budget: int = 20, backoff: float = 1) -> None:
+        self.retries = retries
+        self.host_budget = host_budget
+        self.backoff = backoff
+        self.guard = threading.Lock()
+        self.budgets: dict[str, int] = {}
+
+    @classmethod
+    def get_status(cls, error: Exception) -> int | None:
+        response = getattr(error, 'response', None)
+        return None if response is None else response.status_code
+
+    @classmethod
+    def is_transient(cls, error: Exception) -> bool:
+        if isinstance(error, HTTPError):
+            return cls.get_status(error) in cls.RETRY_STATUSES
+        # certificate failures are connection errors too, but retrying them cannot help
+        if isinstance(error, SSLError):
+            return False
+        # connection resets and timeouts, either before or while reading a reply
+        return isinstance(error, (TransientError, RequestConnectionError, Timeout, ChunkedEncodingError,
+                                  ProtocolError, ReadTimeoutError))
+
+    @staticmethod
+    def get_retry_after(error: Exception) -> float | None:
+        response = getattr(error, 'response', None)
+        value = None if response is None else response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def get_delay(self, attempt: int, error: Exception) -> float:
+        retry_after = self.get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.MAX_DELAY)
+        # exponential backoff, with jitter so that concurrent failures do not retry all at once
+        delay = min(self.backoff * 2 ** attempt, self.MAX_DELAY)
+        return random.uniform(delay / 2, delay)
+
+    def take_budget(self, hostname: str) -> bool:
+        with self.guard:
+            remaining = self.budgets.get(hostname, self.host_budget)
+            if remaining <= 0:
+                return False
+            self.budgets[hostname] = remaining - 1
+            return True
+
+    def call(self, url: str, function: Callable[[], Any]) -> Any:
+        attempt = 0
+        while True:
+            try:
+                return function()
+            except Exception as e:
+                if not self.is_transient(e) or attempt >= self.retries:
+                    raise
+                hostname = urlparse(url).hostname
+                if not self.take_budget(hostname):
+                    logging.warning(f'Retry budget of {hostname} is exhausted, giving up on {url}')
+                    raise
+                delay = self.get_delay(attempt, e)
+                attempt += 1
+                logging.warning(f'Retrying {url} in {delay:.1f}s (attempt {attempt} of {self.retries}): {e}')
+                time.sleep(delay)
+
+
+class HostLimiter:
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.guard = threading.Lock()
+        self.semaphores: dict[str, threading.BoundedSemaphore] = {}
+
+    @contextmanager
+    def hold(self, url: str):
+        hostname = urlparse(url).hostname
+        with self.guard:
+            semaphore = self.semaphores.setdefault(hostname, threading.BoundedSemaphore(self.limit))
+        with semaphore:
+            yield
+
+
 class ProductConfig(BaseModel):
     version: str | None
     os: list[str]
@@ -96,13 +280,33 @@ class JBProductRelease(BaseModel):
     downloads: JBProductReleaseDownload
 
 
+class JBProductReleaseIndex:
+
+    def __init__(self, releases: list[JBProductRelease]) -> None:
+        # releases are sorted newest first, so the first release seen for a key is kept
+        self.by_version: dict[str, JBProductRelease] = {}
+        self.by_build: dict[str, JBProductRelease] = {}
+        for release in releases:
+            self.by_version.setdefault(release.version, release)
+            self.by_build.setdefault(release.build, release)
+
+
 class JBProduct(BaseModel):
     code: str
     name: str
     releases: list[JBProductRelease]
+    _index: JBProductReleaseIndex | None = PrivateAttr(default=None)
+
+    def get_release_index(self) -> JBProductReleaseIndex:
+        if self._index is None:
+            self._index = JBProductReleaseIndex(self.releases)
+        return self._index
 
     def get_release(self, version: str) -> JBProductRelease | None:
-        return next((release for release in self.releases if release.version == version), None)
+        return self.get_release_index().by_version.get(version)
+
+    def get_release_by_build(self, build: str) -> JBProductRelease | None:
+        return self.get_release_index().by_build.get(build)
 
     def get_latest_release(self) -> JBProductRelease | None:
         try:
@@ -139,6 +343,160 @@ class JBPluginUpdate(BaseModel):
     _until_validator = validator('until', allow_reuse=True)(JBPluginUpdateBuildValidator.is_valid)
 
 
+class PluginUpdateTable:
+    # updates are kept as parallel columns, and only turned back into models when selected
+    __slots__ = ('ids', 'timestamps', 'versions', 'since', 'until', 'intervals', 'known_intervals', 'materialized')
+
+    def __init__(self) -> None:
+        self.ids = array('q')
+        self.timestamps = array('q')
+        self.versions: list[str] = []
+        self.since: list[str] = []
+        self.until: list[str] = []
+        self.intervals: list[tuple[tuple[int, ...], tuple[int, ...] | None]] = []
+        # build ranges are shared by many updates of a plugin, so each parsed interval is stored once
+        self.known_intervals: dict[tuple[str, str], tuple[tuple[int, ...], tuple[int, ...] | None]] = {}
+        self.materialized: dict[int, JBPluginUpdate] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def append(self, update: JBPluginUpdate) -> None:
+        self.ids.append(update.id)
+        self.timestamps.append(update.timestamp_ms)
+        self.versions.append(update.version)
+        bounds = (sys.intern(update.since), sys.intern(update.until))
+        interval = self.known_intervals.get(bounds)
+        if interval is None:
+            interval = self.known_intervals[bounds] = PluginCompatibilityIndex.get_interval(update)
+        self.since.append(bounds[0])
+        self.until.append(bounds[1])
+        self.intervals.append(interval)
+
+    def get(self, position: int) -> JBPluginUpdate:
+        update = self.materialized.get(position)
+        if update is None:
+            # columns come from validated updates, so validation is not run again
+            update = JBPluginUpdate.construct(id=self.ids[position], version=self.versions[position],
+                                              timestamp_ms=self.timestamps[position],
+                                              since=self.since[position], until=self.until[position])
+            update = self.materialized.setdefault(position, update)
+        return update
+
+
+class PluginCompatibilityIndex:
+
+    def __init__(self, updates: PluginUpdateTable) -> None:
+        self.updates = updates
+        intervals = updates.intervals
+        bounds = {bound for interval in intervals for bound in interval if bound is not None}
+        self.breakpoints: list[tuple[int, ...]] = sorted(bounds)
+        # for each range between two breakpoints, the position of the newest compatible update
+        self.selected: list[int | None] = []
+        starts: dict[tuple[int, ...], list[int]] = {}
+        ends: dict[tuple[int, ...], list[int]] = {}
+        for position, (low, high) in enumerate(intervals):
+            if high is None or low < high:
+                starts.setdefault(low, []).append(position)
+                if high is not None:
+                    ends.setdefault(high, []).append(position)
+        active, ended = [], set()
+        for breakpoint in self.breakpoints:
+            ended.update(ends.get(breakpoint, ()))
+            for position in starts.get(breakpoint, ()):
+                heapq.heappush(active, position)
+            while active and active[0] in ended:
+                heapq.heappop(active)
+            self.selected.append(active[0] if active else None)
+
+    @staticmethod
+    def get_interval(update: JBPluginUpdate) -> tuple[tuple[int, ...], tuple[int, ...] | None]:
+        # builds up to `until` included on its components are compatible, which is
+        # the half-open range [since, upper) where upper increments the last component
+        since = JetBrainsApi.get_build_tuple(update.since)
+        until = JetBrainsApi.get_build_tuple(update.until)
+        if len(until) == 0:
+            return since, None
+        return since, until[:-1] + (until[-1] + 1,)
+
+    @staticmethod
+    def is_within(interval: tuple[tuple[int, ...], tuple[int, ...] | None], product_tuple: tuple[int, ...]) -> bool:
+        low, high = interval
+        return low <= product_tuple and (high is None or product_tuple < high)
+
+    def find(self, product_tuple: tuple[int, ...]) -> JBPluginUpdate | None:
+        position = bisect.bisect_right(self.breakpoints, product_tuple) - 1
+        if position < 0 or self.selected[position] is None:
+            return None
+        return self.updates.get(self.selected[position])
+
+
+class CompatibilityResolver:
+
+    @classmethod
+    def resolve(cls, builds: list[str],
+                updates: dict[int, PluginUpdateTable]) -> dict[str, dict[int, JBPluginUpdate | None]]:
+        if numpy is None:
+            return cls.resolve_with_index(builds, updates)
+        return cls.resolve_with_numpy(builds, updates)
+
+    @staticmethod
+    def resolve_with_index(builds: list[str],
+                           updates: dict[int, PluginUpdateTable]) -> dict[str, dict[int, JBPluginUpdate | None]]:
+        indexes = {plugin_id: PluginCompatibilityIndex(plugin_updates) for plugin_id, plugin_updates in updates.items()}
+        build_tuples = {build: JetBrainsApi.get_build_tuple(build) for build in builds}
+        return {build: {plugin_id: index.find(build_tuple) for plugin_id, index in indexes.items()}
+                for build, build_tuple in build_tuples.items()}
+
+    @staticmethod
+    def resolve_with_numpy(builds: list[str],
+                           updates: dict[int, PluginUpdateTable]) -> dict[str, dict[int, JBPluginUpdate | None]]:
+        plugin_ids = list(updates)
+        intervals = [interval for plugin_id in plugin_ids for interval in updates[plugin_id].intervals]
+        build_tuples = [JetBrainsApi.get_build_tuple(build) for build in builds]
+        # build tuples have various lengths, so they are compared through their rank in the sorted set of all tuples
+        bounds = {bound for interval in intervals for bound in interval if bound is not None}
+        ranks = {bound: rank for rank, bound in enumerate(sorted(bounds.union(build_tuples)))}
+        unbounded = len(ranks)
+        low = numpy.array([ranks[since] for since, _ in intervals], dtype=numpy.int64)
+        high = numpy.array([unbounded if upper is None else ranks[upper] for _, upper in intervals], dtype=numpy.int64)
+        target = numpy.array([ranks[build_tuple] for build_tuple in build_tuples], dtype=numpy.int64)[:, None]
+        # one row per product build, one column per update of any plugin
+        compatible = (low[None, :] <= target) & (target < high[None, :])
+        positions = numpy.where(compatible, numpy.arange(len(intervals)), len(intervals))
+        matrix = {build: {} for build in builds}
+        start = 0
+        for plugin_id in plugin_ids:
+            end = start + len(updates[plugin_id])
+            # updates are sorted newest first, so the lowest compatible position is selected
+            first = positions[:, start:end].min(axis=1, initial=len(intervals))
+            for build, position in zip(builds, first.tolist()):
+                matrix[build][plugin_id] = updates[plugin_id].get(position - start) if position < end else None
+            start = end
+        return matrix
+
+
+class ProductCompatibility(BaseModel):
+    build: str
+    plugins: dict[int, str | None] = Field(default_factory=dict)
+
+
+class CompatibilityMatrix(BaseModel):
+    DEFAULT_FILE_NAME: ClassVar[str] = 'compatibility.json'
+
+    products: dict[str, ProductCompatibility] = Field(default_factory=dict)
+
+    def write(self, directory: Path) -> Path:
+        file = directory / self.DEFAULT_FILE_NAME
+        logging.info(f'Writing compatibility matrix to {file}')
+        try:
+            with open(file, 'wt') as f:
+                f.write(self.json(indent=4))
+        except OSError as e:
+            raise AppError(f'Could not write compatibility matrix {file}: {e}')
+        return file
+
+
 class UrlTracker(BaseModel):
     DEFAULT_URL_FILE: ClassVar[str] = 'url.json'
 
@@ -180,6 +538,18 @@ class UrlTracker(BaseModel):
         self.request_url = sorted(self.request_url)
         self.response_url = sorted(self.response_url)
 
+    @classmethod
+    def load_hostnames(cls, directory: Path) -> set[str]:
+        file = directory / cls.DEFAULT_URL_FILE
+        try:
+            tracker = cls.parse_file(file)
+        except FileNotFoundError:
+            return set()
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring unreadable tracked url {file}: {e}')
+            return set()
+        return set(tracker.request_hostname) | set(tracker.response_hostname)
+
     def write_tracked_url(self, directory: Path) -> Path:
         target = directory / self.DEFAULT_URL_FILE
         logging.info(f'Writing tracked url to {target}')
@@ -192,47 +562,471 @@ class UrlTracker(BaseModel):
         return target
 
 
+class RedirectMap(BaseModel):
+    DEFAULT_FILE_NAME: ClassVar[str] = 'redirect.json'
+
+    redirects: dict[str, str] = Field(default_factory=dict)
+    _used: set[str] = PrivateAttr(default_factory=set)
+
+    @classmethod
+    def load(cls, directory: Path) -> Self:
+        file = directory / cls.DEFAULT_FILE_NAME
+        try:
+            return cls.parse_file(file)
+        except FileNotFoundError:
+            return cls()
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring unreadable redirect map {file}: {e}')
+            return cls()
+
+    def get(self, url: str) -> str | None:
+        final_url = self.redirects.get(url)
+        if final_url is not None:
+            self._used.add(url)
+        return final_url
+
+    def record(self, url: str, final_url: str) -> None:
+        self.redirects[url] = final_url
+        self._used.add(url)
+
+    def write(self, directory: Path) -> Path:
+        target = directory / self.DEFAULT_FILE_NAME
+        logging.info(f'Writing redirect map to {target}')
+        # only keep entries seen during this run, so that outdated links do not accumulate
+        used = {url: self.redirects[url] for url in sorted(self._used)}
+        try:
+            with open(target, 'wt') as f:
+                f.write(RedirectMap(redirects=used).json(indent=4))
+        except OSError as e:
+            raise AppError(f'Failed to write redirect map {target}: {e}')
+        return target
+
+
+class PartialDownload(BaseModel):
+    SUFFIX: ClassVar[str] = '.part'
+    METADATA_SUFFIX: ClassVar[str] = '.json'
+    CONTENT_RANGE_RE: ClassVar[re.Pattern] = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+    target: Path
+    validator: str | None = None
+    # a single stream has no segments, and is resumed from the size of the part file
+    segments: int = 0
+    completed: list[int] = Field(default_factory=list)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def load(cls, target: Path, segments: int = 0) -> Self:
+        partial = cls(target=target)
+        if partial.offset() > 0:
+            try:
+                with open(partial.metadata_file(), 'rb') as f:
+                    partial = cls(target=target, **json.load(f))
+            except (OSError, ValueError, TypeError):
+                logging.debug(f'No usable resume metadata for {partial.part_file()}')
+        if partial.segments != segments:
+            logging.debug(f'Partial download {partial.part_file()} has another layout: restarting')
+            partial.discard()
+            return cls(target=target)
+        return partial
+
+    @staticmethod
+    def get_validator(response: Response) -> str | None:
+        # weak validators cannot be used for range requests
+        etag = response.headers.get('ETag')
+        return etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+
+    @classmethod
+    def get_content_range_start(cls, response: Response) -> int | None:
+        if response.status_code != 206:
+            return None
+        match = cls.CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+        return None if match is None else int(match[1])
+
+    @classmethod
+    def get_content_range_size(cls, response: Response) -> int | None:
+        match = cls.CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+        return None if match is None or match[3] == '*' else int(match[3])
+
+    def part_file(self) -> Path:
+        return self.target.with_name(self.target.name + self.SUFFIX)
+
+    def metadata_file(self) -> Path:
+        return self.target.with_name(self.target.name + self.SUFFIX + self.METADATA_SUFFIX)
+
+    def offset(self) -> int:
+        try:
+            return self.part_file().stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def save(self) -> None:
+        with open(self.metadata_file(), 'wt') as f:
+            f.write(self.json(exclude={'target'}))
+
+    def start(self, response: Response) -> None:
+        self.validator = self.get_validator(response)
+        self.save()
+
+    def start_segmented(self, response: Response, size: int, segments: int) -> None:
+        with open(self.part_file(), 'wb') as f:
+            f.truncate(size)
+        self.validator = self.get_validator(response)
+        self.segments = segments
+        self.completed = []
+        self.save()
+
+    def complete_segment(self, index: int) -> None:
+        with self._lock:
+            self.completed.append(index)
+            self.save()
+
+    def resume_headers(self) -> dict[str, str]:
+        headers = {'Range': f'bytes={self.offset()}-'}
+        if self.validator is not None:
+            headers['If-Range'] = self.validator
+        return headers
+
+    def is_resumed_by(self, response: Response) -> bool:
+        return self.get_content_range_start(response) == self.offset()
+
+    def complete(self) -> None:
+        os.replace(self.part_file(), self.target)
+        self.metadata_file().unlink(missing_ok=True)
+
+    def discard(self) -> None:
+        self.part_file().unlink(missing_ok=True)
+        self.metadata_file().unlink(missing_ok=True)
+
+
+class SegmentHasher:
+
+    def __init__(self, hasher: Any, file: Path, segments: list[tuple[int, int]], completed: list[int],
+                 chunk_size: int) -> None:
+        self.hasher = hasher
+        self.file = file
+        self.segments = segments
+        self.chunk_size = chunk_size
+        self.guard = threading.Lock()
+        # end of the data written for each segment, segments completed by a previous run are read back
+        self.written = [end + 1 if index in completed else start for index, (start, end) in enumerate(segments)]
+        self.completed = set(completed)
+        # the next segment to hash, and the offset hashed so far
+        self.frontier = 0
+        self.position = 0
+        with self.guard:
+            self.advance()
+
+    def update(self, index: int, chunk: bytes) -> None:
+        # data written at the hash position is hashed as it streams, without being read back
+        with self.guard:
+            if index == self.frontier and self.written[index] == self.position:
+                self.hasher.update(chunk)
+                self.position += len(chunk)
+            self.written[index] += len(chunk)
+
+    def complete(self, index: int) -> None:
+        with self.guard:
+            self.completed.add(index)
+            self.advance()
+
+    def advance(self) -> None:
+        # only the data written ahead of the hash position is read back from the disk
+        with open(self.file, 'rb') as f:
+            f.seek(self.position)
+            while self.frontier < len(self.segments):
+                while self.position < self.written[self.frontier]:
+                    chunk = f.read(min(self.chunk_size, self.written[self.frontier] - self.position))
+                    if not chunk:
+                        raise TransientError(f'Segment {self.frontier} of {self.file.name} could not be read back')
+                    self.hasher.update(chunk)
+                    self.position += len(chunk)
+                if self.frontier not in self.completed:
+                    break
+                self.frontier += 1
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest().lower()
+
+
+class CacheEntry(BaseModel):
+    value: Any = None
+    # pickled models, already validated from the reply
+    models: str | None = None
+    url: str | None = None
+    etag: str | None = None
+    last_modified: str | None = None
+    expires: float = 0
+    _decoded: Any = PrivateAttr(default=None)
+
+    @staticmethod
+    def get_cache_directives(response: Response) -> dict[str, str | None]:
+        directives = {}
+        for item in response.headers.get('Cache-Control', '').split(','):
+            name, _, value = item.strip().partition('=')
+            if name:
+                directives[name.lower()] = value.strip('"') if value else None
+        return directives
+
+    @classmethod
+    def is_storable(cls, response: Response) -> bool:
+        return response.status_code == 200 and 'no-store' not in cls.get_cache_directives(response)
+
+    @classmethod
+    def get_expires(cls, response: Response) -> float:
+        # without max-age, the reply is stored but revalidated on every use
+        directives = cls.get_cache_directives(response)
+        if 'no-cache' in directives:
+            return 0
+        try:
+            max_age = int(directives.get('max-age') or 0)
+            age = int(response.headers.get('Age', 0))
+        except ValueError:
+            return 0
+        return time.time() + max(max_age - age, 0)
+
+    @classmethod
+    def from_response(cls, response: Response, value: Any) -> Self:
+        return cls(value=value, url=response.request.url, etag=response.headers.get('ETag'),
+                   last_modified=response.headers.get('Last-Modified'), expires=cls.get_expires(response))
+
+    def with_models(self, models: Any) -> Self:
+        self.models = base64.b64encode(pickle.dumps(models, pickle.HIGHEST_PROTOCOL)).decode()
+        self._decoded = models
+        return self
+
+    def get_value(self) -> Any:
+        if self.models is None:
+            return self.value
+        if self._decoded is None:
+            self._decoded = pickle.loads(base64.b64decode(self.models))
+        return self._decoded
+
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires
+
+    def revalidation_headers(self) -> dict[str, str]:
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def revalidated(self, response: Response) -> Self:
+        # a 304 reply may update the validators and the freshness, but never the value
+        return self.copy(update={'url': response.request.url,
+                                 'etag': response.headers.get('ETag', self.etag),
+                                 'last_modified': response.headers.get('Last-Modified', self.last_modified),
+                                 'expires': self.get_expires(response)})
+
+
 class Cache:
 
-    def get(self, key: str) -> Any:
+    def get(self, key: str) -> CacheEntry:
         raise NotImplementedError()
 
-    def put(self, key: str, value: Any) -> None:
+    def put(self, key: str, entry: CacheEntry) -> None:
         raise NotImplementedError()
 
+    def flush(self) -> None:
+        pass
+
+    def collect(self) -> None:
+        pass
+
 
 class JetBrainsApi:
     DATA_URL = 'https://data.services.jetbrains.com'
     PLUGIN_URL = 'https://plugins.jetbrains.com'
-
-    def __init__(self, *, tracker: UrlTracker, cache: Cache) -> None:
+    CHUNK_SIZE = 1024 * 1024
+    # seconds to connect, and to wait for each read, so that a stalled connection fails and is retried
+    TIMEOUT = (15, 60)
+    # to be increased whenever a cached model changes
+    MODEL_SCHEMA_VERSION = 1
+    # pages of plugin updates are requested once per run and folded into a compact table
+    TRANSIENT_KINDS = ('plugin-updates',)
+
+    def __init__(self, *, tracker: UrlTracker, cache: Cache, redirects: RedirectMap,
+                 segments: int = 1, segment_threshold: int = 0, pool_size: int = DEFAULT_POOLSIZE,
+                 host_limit: int = DEFAULT_POOLSIZE, cache_models: bool = False,
+                 host_pools: dict[str, int] = None, known_hosts: set[str] = None,
+                 retry_policy: RetryPolicy = None) -> None:
         self.session = Session()
+        self.retry_policy = retry_policy or RetryPolicy()
+        host_pools = host_pools or {}
+        # one pool is kept for each host seen in the previous run, including redirect targets, so that
+        # their connections are reused all along instead of being dropped when too many hosts are used
+        hosts = {urlparse(self.DATA_URL).hostname, urlparse(self.PLUGIN_URL).hostname}
+        hosts.update(known_hosts or ())
+        # segmented downloads use several connections to the same host at once
+        adapter = HTTPAdapter(pool_connections=max(DEFAULT_POOLSIZE, len(hosts)), pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.adapters = [adapter]
+        for hostname, size in host_pools.items():
+            # a configured host never opens more connections than its pool, requests wait for a free one
+            host_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=True)
+            for scheme in ('https', 'http'):
+                # with or without an explicit port
+                self.session.mount(f'{scheme}://{hostname}/', host_adapter)
+                self.session.mount(f'{scheme}://{hostname}:', host_adapter)
+            self.adapters.append(host_adapter)
+        self.segments = segments
+        self.segment_threshold = segment_threshold
         self.cache = cache
+        self.cache_models = cache_models
         self.url_tracker = tracker
+        self.redirects = redirects
+        self.download_locks = KeyedLock()
+        self.query_flights = SingleFlight()
+        self.host_limiter = HostLimiter(host_limit)
+        # digests computed while downloading, to avoid reading the files again
+        self.streamed_digests: dict[Path, str] = {}
+
+    def get_connection_statistics(self) -> dict[str, tuple[int, int]]:
+        statistics = {}
+        for adapter in self.adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                connections, requests = statistics.get(pool.host, (0, 0))
+                statistics[pool.host] = (connections + pool.num_connections, requests + pool.num_requests)
+        return statistics
+
+    def do_cached_query(self, request: PreparedRequest) -> Any:
+        # concurrent callers for the same url share a single request
+        return self.query_flights.do(request.url, lambda: self.do_query(request, request.url))
+
+    def do_model_query(self, request: PreparedRequest, kind: str, parse: Callable[[Any], Any]) -> Any:
+        if not self.cache_models:
+            return parse(self.do_cached_query(request))
+        # the schema version is part of the key, so that models of an older layout are never loaded
+        key = f'models:{self.MODEL_SCHEMA_VERSION}:{kind}:{request.url}'
+        return self.query_flights.do(key, lambda: self.do_query(request, key, parse))
 
-    def do_cached_query(self, request: PreparedRequest) -> dict:
-        self.url_tracker.track_request_url(request.url)
+    @classmethod
+    def is_kept_in_memory(cls, key: str) -> bool:
+        # model keys are made of a prefix, the schema version, the kind and the url
+        return key.startswith('models:') and key.split(':')[2] not in cls.TRANSIENT_KINDS
+
+    def get_cache_entry(self, key: str) -> CacheEntry | None:
         try:
-            data = self.cache.get(request.url)
+            entry = self.cache.get(key)
+            entry.get_value()
+            return entry
         except KeyError:
-            response = self.session.send(request)
-            self.url_tracker.track_response_url(response.request.url)
-            data = response.json()
-            self.cache.put(request.url, data)
-        return data
+            return None
+        except Exception as e:
+            logging.debug(f'Ignoring undecodable cache entry for {key}: {e}')
+            return None
 
-    def get_product(self, product_id: str) -> JBProduct:
+    def do_query(self, request: PreparedRequest, key: str, parse: Callable[[Any], Any] | None = None) -> Any:
+        self.url_tracker.track_request_url(request.url)
+        entry = self.get_cache_entry(key)
+        if entry is not None and entry.is_fresh():
+            logging.debug(f'Using fresh cached reply for {request.url}')
+            if entry.url is not None:
+                self.url_tracker.track_response_url(entry.url)
+            return entry.get_value()
+        if entry is not None:
+            request.headers.update(entry.revalidation_headers())
+        try:
+            response = self.retry_policy.call(request.url, lambda: self.send_query(request))
+        except RequestException as e:
+            raise AppError(f'Query of {request.url} failed: {e}')
+        self.url_tracker.track_response_url(response.request.url)
+        if entry is not None and response.status_code == 304:
+            logging.debug(f'Cached reply for {request.url} is still valid')
+            entry = entry.revalidated(response)
+        else:
+            if parse is None:
+                entry = CacheEntry.from_response(response, response.json())
+            else:
+                entry = CacheEntry.from_response(response, None).with_models(parse(response.json()))
+            if not CacheEntry.is_storable(response):
+                return entry.get_value()
+        self.cache.put(key, entry)
+        return entry.get_value()
+
+    def send_query(self, request: PreparedRequest) -> Response:
+        with self.host_limiter.hold(request.url):
+            response = self.session.send(request, timeout=self.TIMEOUT)
+        # other failures are reported by the parsing of the reply, as before
+        if response.status_code in RetryPolicy.RETRY_STATUSES:
+            response.raise_for_status()
+        return response
+
+    @staticmethod
+    def get_release_filter(version: str | None) -> dict[str, str]:
+        if version is None:
+            return {'latest': 'true'}
+        return {'release.version': version}
+
+    @staticmethod
+    def narrow_releases(item: dict, version: str | None) -> dict:
+        # releases which will never be used are dropped before validation
+        releases = item.get('releases')
+        if not isinstance(releases, list):
+            return item
+        if version is None:
+            releases = releases[:1]
+        else:
+            releases = [release for release in releases
+                        if isinstance(release, dict) and version in (release.get('version'), release.get('build'))]
+        return {**item, 'releases': releases}
+
+    @classmethod
+    def parse_product(cls, product_id: str, data: Any, version: str | None) -> JBProduct:
+        if not isinstance(data, list) or len(data) != 1 or not isinstance(data[0], dict):
+            raise AppError(f'Product information for {product_id} is not in a recognized format')
+        return JBProduct(**cls.narrow_releases(data[0], version))
+
+    def get_product(self, product_id: str, version: str = None) -> JBProduct:
         params = {"code": product_id, "release.type": JBProductReleaseType.release.value}
         request = Request('GET', f'{self.DATA_URL}/products', params=params).prepare()
-        data = self.do_cached_query(request)
-        if not isinstance(data, list) or len(data) != 1:
-            raise AppError(f'Product information for {product_id} is not in a recognized format')
-        return JBProduct(**data[0])
+        return self.do_model_query(request, f'product:{version}',
+                                   lambda data: self.parse_product(product_id, data, version))
+
+    @classmethod
+    def parse_products(cls, data: Any, versions: dict[str, str | None]) -> dict[str, JBProduct]:
+        if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+            raise AppError(f'Product information for {list(versions)} is not in a recognized format')
+        # each product is narrowed to its own configured version, unrequested products are not validated
+        return {item['code']: JBProduct(**cls.narrow_releases(item, versions[item['code']]))
+                for item in data if item.get('code') in versions}
+
+    def get_products(self, versions: dict[str, str | None], narrow: bool = True) -> dict[str, JBProduct]:
+        product_ids = list(versions)
+        if len(product_ids) == 0:
+            return {}
+        params = {"code": ','.join(product_ids), "release.type": JBProductReleaseType.release.value}
+        # the release filter applies to every product of the query, so it is only used when they share a version,
+        # otherwise all releases are received and narrowed on the client before validation
+        filtered = narrow and len(set(versions.values())) == 1
+        if filtered:
+            params.update(self.get_release_filter(versions[product_ids[0]]))
+        request = Request('GET', f'{self.DATA_URL}/products', params=params).prepare()
+        kind = 'products:' + ','.join(f'{product_id}={version}' for product_id, version in versions.items())
+        try:
+            products = self.do_model_query(request, kind, lambda data: self.parse_products(data, versions))
+            missing = [product_id for product_id in product_ids if product_id not in products]
+            if len(missing) > 0:
+                raise AppError(f'Product information for {missing} is missing')
+            if filtered and any(len(products[product_id].releases) == 0 for product_id in product_ids):
+                logging.debug(f'Narrowed query for {product_ids} missed releases, querying all releases')
+                return self.get_products(versions, narrow=False)
+            return {product_id: products[product_id] for product_id in product_ids}
+        except (AppError, RequestException, ValueError) as e:
+            logging.warning(f'Batched product query failed, falling back to one query per product : {e}')
+            return {product_id: self.get_product(product_id, version) for product_id, version in versions.items()}
 
     def get_plugin(self, plugin_id: int) -> JBPlugin:
         logging.debug(f'Getting information for plugin {plugin_id}')
         req = Request('GET', f'{self.PLUGIN_URL}/api/plugins/{plugin_id}').prepare()
-        data = self.do_cached_query(req)
+        return self.do_model_query(req, 'plugin', lambda data: self.parse_plugin(plugin_id, data))
+
+    @staticmethod
+    def parse_plugin(plugin_id: int, data: Any) -> JBPlugin:
         if not isinstance(data, dict):
             raise AppError(f'Plugin information for {plugin_id} is not in a recognized format')
         return JBPlugin(**data)
@@ -241,73 +1035,272 @@ class JetBrainsApi:
         logging.debug(f'Getting updates for plugin {plugin_id} {page=}({page_size=})')
         params = {'page': page, 'size': page_size}
         req = Request('GET', f'{self.PLUGIN_URL}/api/plugins/{plugin_id}/updates', params=params).prepare()
-        data = self.do_cached_query(req)
+        return self.do_model_query(req, 'plugin-updates', lambda data: self.parse_plugin_updates(plugin_id, data))
+
+    @staticmethod
+    def parse_plugin_updates(plugin_id: int, data: Any) -> list[JBPluginUpdate]:
         if not isinstance(data, list):
             raise AppError(f'Plugin updates for {plugin_id} is not in a recognized format')
         return [JBPluginUpdate(**item) for item in data]
 
-    def get_plugin_updates_all(self, plugin_id: int, page_size: int = 100) -> list[JBPluginUpdate]:
-        logging.debug(f'Getting all updates for plugin {plugin_id} ({page_size=})')
-        # key=lambda x: x.timestamp_ms, reverse=True
+    def iter_plugin_updates(self, plugin_id: int, page_size: int = 100) -> Iterator[JBPluginUpdate]:
+        # pages are only requested when the consumer needs more updates
         page = 0
-        updates = []
         while True:
             items = self.get_plugin_updates(plugin_id, page, page_size)
             logging.debug(f'Updates received: {len(items)}')
-            updates.extend(items)
+            yield from items
             if len(items) < page_size:
                 break
             page += 1
-        logging.info(f'Found {len(updates)} releases for plugin id {plugin_id}')
-        return updates
 
-    def download_file(self, url: str, directory: Path, *, params: dict = None) -> Path:
+    def get_local_target(self, url: str, directory: Path) -> Path | None:
+        # only trust recorded redirects, so that the final url can still be tracked without any request
+        final_url = self.redirects.get(url)
+        if final_url is None:
+            return None
+        return directory / os.path.basename(urlparse(final_url).path)
+
+    def download_file(self, url: str, directory: Path, *, params: dict = None, size: int = None,
+                      algorithm: str = None) -> Path:
         if params is None:
             params = {}
         logging.debug(f'Downloading {url} to {directory}')
+        request = Request('GET', url, params=params).prepare()
+        self.url_tracker.track_request_url(request.url)
+        # concurrent downloads of the same url would otherwise write the same target
+        with self.download_locks.hold(request.url):
+            return self.download_request(request, directory, size, algorithm)
+
+    def download_request(self, request: PreparedRequest, directory: Path, size: int | None,
+                         algorithm: str | None) -> Path:
+        target = self.get_local_target(request.url, directory)
+        if target is not None and target.exists():
+            logging.debug(f'File {target.name} already exists locally: skipping request')
+            self.url_tracker.track_response_url(self.redirects.get(request.url))
+            return target
         directory.mkdir(parents=True, exist_ok=True)
-        target = None
-        try:
-            request = Request('GET', url, params=params).prepare()
-            self.url_tracker.track_request_url(request.url)
-            response = self.session.send(request, stream=True)
-            self.url_tracker.track_response_url(response.request.url)
-            file = os.path.basename(urlparse(response.request.url).path)
-            target = directory / file
-            if target.exists():
-                logging.debug(f'File {file} already exists: skipping download')
-                return target
-            logging.info(f'Downloading {file}...')
-            with open(target, 'wb') as f:
-                # noinspection PyTypeChecker
-                shutil.copyfileobj(response.raw, f)  # type hint issue for f
+        try:
+            # transient failures are retried, resuming from the partial file of the previous attempt
+            return self.retry_policy.call(request.url, lambda: self.fetch(request, directory, size, algorithm))
+        except AppError:
+            raise
         except Exception as e:
-            if target is not None:
-                target.unlink(missing_ok=True)
-            raise AppError(f'Failed to download {url}, eventual file {target} was purged : {e}')
+            raise AppError(f'Failed to download {request.url}, eventual partial file was kept for resuming : {e}')
+
+    def fetch(self, request: PreparedRequest, directory: Path, size: int | None, algorithm: str | None) -> Path:
+        if self.is_segmented(size):
+            return self.fetch_segmented_file(request, directory, size, algorithm)
+        # the redirect may have been recorded by a previous attempt
+        return self.fetch_file(request, directory, self.get_local_target(request.url, directory), algorithm)
+
+    def send_download(self, request: PreparedRequest, partial: PartialDownload | None) -> Response:
+        if partial is not None and partial.offset() > 0:
+            resume = request.copy()
+            resume.headers.update(partial.resume_headers())
+            response = self.session.send(resume, stream=True, timeout=self.TIMEOUT)
+            if response.status_code != 416:
+                return self.check_download(response)
+            logging.debug(f'Range not satisfiable for {partial.part_file()}: restarting')
+            response.close()
+            partial.discard()
+        return self.check_download(self.session.send(request, stream=True, timeout=self.TIMEOUT))
+
+    @staticmethod
+    def check_download(response: Response) -> Response:
+        # a streamed reply holds its connection until closed, which would use up a blocking host pool for good
+        if not response.ok:
+            response.close()
+            response.raise_for_status()
+        return response
+
+    def fetch_file(self, request: PreparedRequest, directory: Path, target: Path | None,
+                   algorithm: str | None) -> Path:
+        # the target name is only known beforehand if the redirect has been recorded
+        partial = PartialDownload.load(target) if target is not None else None
+        response = self.send_download(request, partial)
+        self.url_tracker.track_response_url(response.request.url)
+        self.redirects.record(request.url, response.request.url)
+        target = directory / os.path.basename(urlparse(response.request.url).path)
+        if target.exists():
+            response.close()
+            logging.debug(f'File {target.name} already exists: skipping download')
+            return target
+        if partial is None or partial.target != target:
+            partial = PartialDownload.load(target)
+            if partial.offset() > 0 and response.headers.get('Accept-Ranges') == 'bytes':
+                response.close()
+                response = self.send_download(Request('GET', response.request.url).prepare(), partial)
+        digest = self.write_response(response, partial, algorithm)
+        partial.complete()
+        if digest is not None:
+            self.streamed_digests[target] = digest
         return target
 
-    def download_plugin(self, plugin_update_id: int, directory: Path) -> Path:
+    def is_segmented(self, size: int | None) -> bool:
+        return self.segments > 1 and size is not None and size >= self.segment_threshold
+
+    def get_segments(self, size: int) -> list[tuple[int, int]]:
+        length = -(-size // self.segments)
+        return [(start, min(start + length, size) - 1) for start in range(0, size, length)]
+
+    def fetch_segmented_file(self, request: PreparedRequest, directory: Path, size: int,
+                             algorithm: str | None) -> Path:
+        # probing with a single byte range follows redirects and tells if ranges are supported
+        probe = request.copy()
+        probe.headers['Range'] = 'bytes=0-0'
+        with self.session.send(probe, stream=True, timeout=self.TIMEOUT) as response:
+            response.raise_for_status()
+        self.url_tracker.track_response_url(response.request.url)
+        self.redirects.record(request.url, response.request.url)
+        target = directory / os.path.basename(urlparse(response.request.url).path)
+        if target.exists():
+            logging.debug(f'File {target.name} already exists: skipping download')
+            return target
+        validator = PartialDownload.get_validator(response)
+        # without a validator, segments could silently mix two versions of the file
+        if PartialDownload.get_content_range_size(response) != size or validator is None:
+            logging.debug(f'Ranges are not supported for {target.name}: downloading as a single stream')
+            return self.fetch_file(request, directory, target, algorithm)
+        segments = self.get_segments(size)
+        partial = PartialDownload.load(target, len(segments))
+        if partial.validator != validator or partial.offset() != size:
+            logging.info(f'Downloading {target.name} in {len(segments)} segments...')
+            partial.start_segmented(response, size, len(segments))
+        else:
+            logging.info(f'Resuming {target.name}, {len(segments) - len(partial.completed)} segments left...')
+        pending = [(index, segment) for index, segment in enumerate(segments) if index not in partial.completed]
+        # segments land out of order, the one at the hash position is hashed while it streams,
+        # and only the data of the following ones already written has to be read back
+        hasher = None if algorithm is None else SegmentHasher(Hasher.get_hash_function(algorithm)(),
+                                                              partial.part_file(), segments, partial.completed,
+                                                              self.CHUNK_SIZE)
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [executor.submit(self.fetch_segment, response.request.url, partial, index, segment, hasher)
+                       for index, segment in pending]
+            for future in as_completed(futures):
+                future.result()
+        partial.complete()
+        if hasher is not None:
+            self.streamed_digests[target] = hasher.hexdigest()
+        return target
+
+    def fetch_segment(self, url: str, partial: PartialDownload, index: int, segment: tuple[int, int],
+                      hasher: SegmentHasher | None) -> None:
+        start, end = segment
+        headers = {'Range': f'bytes={start}-{end}', 'If-Range': partial.validator}
+        segment_request = Request('GET', url, headers=headers).prepare()
+        with self.session.send(segment_request, stream=True, timeout=self.TIMEOUT) as response:
+            response.raise_for_status()
+            if PartialDownload.get_content_range_start(response) != start:
+                partial.discard()
+                raise AppError(f'File {partial.target.name} changed on server during download, restart needed')
+            with open(partial.part_file(), 'r+b') as f:
+                f.seek(start)
+                for chunk in iter(lambda: response.raw.read(self.CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    if hasher is not None:
+                        # the chunk has to be on disk before another segment may need to read it back
+                        f.flush()
+                        hasher.update(index, chunk)
+                written = f.tell() - start
+        if written != end - start + 1:
+            raise TransientError(f'Incomplete segment {index} of {partial.target.name}, will resume later')
+        partial.complete_segment(index)
+        if hasher is not None:
+            hasher.complete(index)
+
+    def write_response(self, response: Response, partial: PartialDownload, algorithm: str | None) -> str | None:
+        if partial.is_resumed_by(response):
+            logging.info(f'Resuming {partial.target.name} from byte {partial.offset()}...')
+            mode = 'a+b'
+        else:
+            logging.info(f'Downloading {partial.target.name}...')
+            partial.start(response)
+            mode = 'w+b'
+        offset = partial.offset() if mode == 'a+b' else 0
+        length = response.headers.get('Content-Length')
+        hasher = None if algorithm is None else Hasher.get_hash_function(algorithm)()
+        with response, open(partial.part_file(), mode) as f:
+            if hasher is not None:
+                # the already downloaded part has to be hashed first, appending still writes at the end
+                f.seek(0)
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+            for chunk in iter(lambda: response.raw.read(self.CHUNK_SIZE), b''):
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+        if length is not None and partial.offset() != offset + int(length):
+            raise TransientError(f'Incomplete download of {partial.target.name}, '
+                                 f'will resume from byte {partial.offset()}')
+        return None if hasher is None else hasher.hexdigest().lower()
+
+    def get_recorded_url(self, url: str) -> str | None:
+        return self.redirects.get(Request('GET', url).prepare().url)
+
+    def get_plugin_download_url(self, plugin_update_id: int) -> str:
         params = {'rel': True, 'updateId': plugin_update_id}
-        return self.download_file(f'{self.PLUGIN_URL}/plugin/download', directory, params=params)
+        return Request('GET', f'{self.PLUGIN_URL}/plugin/download', params=params).prepare().url
+
+    def download_plugin(self, plugin_update_id: int, directory: Path) -> Path:
+        return self.download_file(self.get_plugin_download_url(plugin_update_id), directory)
 
     @staticmethod
     def get_build_tuple(build: str) -> tuple | None:
         return tuple(int(x) for x in build.split('.') if x.strip() not in ('*', ''))
 
+
+class MemoryCache(Cache):
+
+    def __init__(self, backend: Cache, max_size: int = 16 * 1024 * 1024,
+                 is_kept: Callable[[str], bool] = lambda key: True) -> None:
+        self.backend = backend
+        self.max_size = max_size
+        self.is_kept = is_kept
+        self.guard = threading.Lock()
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.size = 0
+
     @staticmethod
-    def is_build_between(since: tuple, target: tuple, until: tuple) -> bool:
-        low = since <= target
-        high = True
-        for target_v, until_v in zip(target, until):
-            if target_v < until_v:
-                high = True
-                break
-            if target_v > until_v:
-                high = False
-                break
-        logging.debug(f'Testing for {since} <= {target} <= {until} : {low=} {high=}')
-        return low and high
+    def get_size(entry: CacheEntry) -> int:
+        # the pickled form is a fair estimate of the memory used by the decoded models
+        return len(entry.models)
+
+    def remember(self, key: str, entry: CacheEntry) -> None:
+        # only parsed models are kept, raw replies such as unnarrowed product lists would be decoded again anyway
+        if entry.models is None or not self.is_kept(key) or self.get_size(entry) > self.max_size:
+            return
+        with self.guard:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= self.get_size(previous)
+            self.entries[key] = entry
+            self.size += self.get_size(entry)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.get_size(evicted)
+
+    def get(self, key: str) -> CacheEntry:
+        with self.guard:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                logging.debug(f'Memory cache hit for {key}')
+                return entry
+        entry = self.backend.get(key)
+        self.remember(key, entry)
+        return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        self.remember(key, entry)
+        self.backend.put(key, entry)
+
+    def flush(self) -> None:
+        self.backend.flush()
+
+    def collect(self) -> None:
+        self.backend.collect()
 
 
 class NoCache(Cache):
@@ -315,16 +1308,35 @@ class NoCache(Cache):
     def __init__(self) -> None:
         pass
 
-    def get(self, key: str) -> Any:
+    def get(self, key: str) -> CacheEntry:
         raise KeyError(key)
 
-    def put(self, key: str, value: Any) -> None:
+    def put(self, key: str, entry: CacheEntry) -> None:
         pass
 
 
+class CacheIndexItem(BaseModel):
+    size: int
+    accessed: float
+
+
+class CacheIndex(BaseModel):
+    DEFAULT_FILE_NAME: ClassVar[str] = 'index.json'
+
+    items: dict[str, CacheIndexItem] = Field(default_factory=dict)
+
+
 class DiskCache(BaseModel, Cache):
+    # eviction goes below the budget, so that it does not happen again on the next write
+    EVICTION_RATIO: ClassVar[float] = 0.9
+
     destination: Path = Path('cache')
     algorithm: str = 'sha256'
+    max_entries: int | None = None
+    max_size: int | None = None
+    _index: CacheIndex = PrivateAttr(default_factory=CacheIndex)
+    _size: int = PrivateAttr(default=0)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
 
     def __init__(self, **kw):
         super().__init__(**kw)
@@ -332,6 +1344,32 @@ class DiskCache(BaseModel, Cache):
             self.destination.mkdir(parents=True, exist_ok=True)
         except OSError as e:
             raise AppError(f'Failed to ensure cache directory exists: {e}')
+        self._index = self.load_index()
+        self._size = sum(item.size for item in self._index.items.values())
+
+    def index_path(self) -> Path:
+        return self.destination / CacheIndex.DEFAULT_FILE_NAME
+
+    def load_index(self) -> CacheIndex:
+        file = self.index_path()
+        try:
+            return CacheIndex.parse_file(file)
+        except FileNotFoundError:
+            logging.debug(f'No cache index at {file}, rebuilding it')
+        except (OSError, ValueError) as e:
+            logging.warning(f'Rebuilding unreadable cache index {file}: {e}')
+        return self.scan_index()
+
+    def scan_index(self) -> CacheIndex:
+        # without an index, entries are considered as last accessed when they were written
+        index = CacheIndex()
+        for file in self.destination.glob('*/*'):
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            index.items[file.name] = CacheIndexItem(size=stat.st_size, accessed=stat.st_mtime)
+        return index
 
     def file_key(self, key: str) -> str:
         h = hashlib.new(self.algorithm)
@@ -339,27 +1377,197 @@ class DiskCache(BaseModel, Cache):
         return h.hexdigest()
 
     def file_path(self, key: str) -> Path:
-        self.destination.mkdir(parents=True, exist_ok=True)
-        return self.destination / self.file_key(key)
+        return self.key_path(self.file_key(key))
+
+    def key_path(self, file_key: str) -> Path:
+        # entries are spread over sub-directories, so that no directory holds too many files
+        return self.destination / file_key[:2] / file_key
 
-    def get(self, key: str) -> Any:
+    def get(self, key: str) -> CacheEntry:
         file = self.file_path(key)
         try:
-            with open(file, 'rb') as f:
-                logging.debug(f'Cache hit for {key} at {file}')
-                return json.load(f)
+            entry = CacheEntry.parse_file(file)
         except FileNotFoundError:
             logging.debug(f'Cache miss for {key} at {file}')
             raise KeyError(key)
-
-    def put(self, key: str, value: Any) -> None:
+        except (OSError, ValueError) as e:
+            logging.debug(f'Ignoring unreadable cache entry for {key} at {file}: {e}')
+            raise KeyError(key)
+        logging.debug(f'Cache hit for {key} at {file}')
+        with self._lock:
+            item = self._index.items.get(file.name)
+            if item is not None:
+                item.accessed = time.time()
+        return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
         file = self.file_path(key)
+        content = entry.json()
         try:
+            file.parent.mkdir(exist_ok=True)
             with open(file, 'wt') as f:
-                f.write(json.dumps(value))
+                f.write(content)
         except OSError as e:
             raise AppError(f'Could not write disk cache for key {key}: {e}')
         logging.debug(f'Caching flush for {key} at {file}')
+        with self._lock:
+            previous = self._index.items.get(file.name)
+            self._size += len(content) - (previous.size if previous is not None else 0)
+            self._index.items[file.name] = CacheIndexItem(size=len(content), accessed=time.time())
+            self.evict()
+
+    def is_within_budget(self, ratio: float = 1.0) -> bool:
+        return ((self.max_entries is None or len(self._index.items) <= self.max_entries * ratio) and
+                (self.max_size is None or self._size <= self.max_size * ratio))
+
+    def remove(self, file_key: str) -> None:
+        item = self._index.items.pop(file_key)
+        self._size -= item.size
+        try:
+            self.key_path(file_key).unlink(missing_ok=True)
+        except OSError as e:
+            logging.warning(f'Could not remove cache entry {file_key}: {e}')
+
+    def evict(self) -> int:
+        # the lock is held by the caller
+        if self.is_within_budget():
+            return 0
+        items = self._index.items
+        evicted = 0
+        for file_key in sorted(items, key=lambda k: items[k].accessed):
+            if self.is_within_budget(self.EVICTION_RATIO):
+                break
+            self.remove(file_key)
+            evicted += 1
+        logging.debug(f'Evicted {evicted} least recently used cache entries')
+        return evicted
+
+    def collect(self) -> None:
+        logging.info(f'Collecting garbage in cache {self.destination}...')
+        removed = 0
+        with self._lock:
+            # files missing from the index come from interrupted runs or from the former flat layout
+            try:
+                for entry in self.destination.iterdir():
+                    if entry.is_dir():
+                        for file in entry.iterdir():
+                            if file.name not in self._index.items:
+                                file.unlink()
+                                removed += 1
+                        if not any(entry.iterdir()):
+                            entry.rmdir()
+                    elif entry != self.index_path():
+                        entry.unlink()
+                        removed += 1
+            except OSError as e:
+                raise AppError(f'Could not collect garbage in cache {self.destination}: {e}')
+            for file_key in [k for k in self._index.items if not self.key_path(k).is_file()]:
+                self._index.items.pop(file_key)
+            self._size = sum(item.size for item in self._index.items.values())
+            removed += self.evict()
+        self.flush()
+        logging.info(f'Removed {removed} cache files, {len(self._index.items)} entries remain for {self._size} bytes')
+
+    def flush(self) -> None:
+        file = self.index_path()
+        with self._lock:
+            content = self._index.json()
+        try:
+            with open(file.with_suffix('.tmp'), 'wt') as f:
+                f.write(content)
+            os.replace(file.with_suffix('.tmp'), file)
+        except OSError as e:
+            raise AppError(f'Could not write cache index {file}: {e}')
+
+
+class SqliteCache(BaseModel, Cache):
+    EVICTION_RATIO: ClassVar[float] = DiskCache.EVICTION_RATIO
+    SCHEMA: ClassVar[str] = ('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, entry TEXT NOT NULL, '
+                             'size INTEGER NOT NULL, accessed REAL NOT NULL)')
+
+    file: Path = Path('cache.sqlite')
+    max_entries: int | None = None
+    max_size: int | None = None
+    timeout: float = 30
+    _connection: sqlite3.Connection | None = PrivateAttr(default=None)
+    _lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        try:
+            # threads share the connection under the lock, and WAL lets other processes read while one writes
+            self._connection = sqlite3.connect(self.file, timeout=self.timeout, check_same_thread=False,
+                                               isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(self.SCHEMA)
+            self._connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        except sqlite3.Error as e:
+            raise AppError(f'Failed to open cache database {self.file}: {e}')
+
+    def execute(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        try:
+            with self._lock:
+                return self._connection.execute(sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            raise AppError(f'Cache database {self.file} failed: {e}')
+
+    def get(self, key: str) -> CacheEntry:
+        rows = self.execute('SELECT entry FROM entries WHERE key = ?', (key,))
+        if not rows:
+            logging.debug(f'Cache miss for {key} in {self.file}')
+            raise KeyError(key)
+        try:
+            entry = CacheEntry.parse_raw(rows[0][0])
+        except ValueError as e:
+            logging.debug(f'Ignoring unreadable cache entry for {key} in {self.file}: {e}')
+            raise KeyError(key)
+        logging.debug(f'Cache hit for {key} in {self.file}')
+        self.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        content = entry.json()
+        self.execute('INSERT OR REPLACE INTO entries (key, entry, size, accessed) VALUES (?, ?, ?, ?)',
+                     (key, content, len(content), time.time()))
+        logging.debug(f'Caching flush for {key} in {self.file}')
+        self.evict()
+
+    def is_within_budget(self, entries: int, size: int, ratio: float = 1.0) -> bool:
+        return ((self.max_entries is None or entries <= self.max_entries * ratio) and
+                (self.max_size is None or size <= self.max_size * ratio))
+
+    def evict(self) -> int:
+        # the lock is held throughout, so that concurrent writers do not evict the same budget twice
+        with self._lock:
+            entries, size = self.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries')[0]
+            if self.is_within_budget(entries, size):
+                return 0
+            evicted = []
+            for key, item_size in self.execute('SELECT key, size FROM entries ORDER BY accessed'):
+                if self.is_within_budget(entries, size, self.EVICTION_RATIO):
+                    break
+                evicted.append((key,))
+                entries -= 1
+                size -= item_size
+            try:
+                self._connection.executemany('DELETE FROM entries WHERE key = ?', evicted)
+            except sqlite3.Error as e:
+                raise AppError(f'Cache database {self.file} failed: {e}')
+        logging.debug(f'Evicted {len(evicted)} least recently used cache entries')
+        return len(evicted)
+
+    def collect(self) -> None:
+        logging.info(f'Collecting garbage in cache {self.file}...')
+        removed = self.evict()
+        # free pages are only given back to the file system by a vacuum
+        self.execute('VACUUM')
+        self.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        entries, size = self.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries')[0]
+        logging.info(f'Removed {removed} cache entries, {entries} entries remain for {size} bytes')
+
+    def flush(self) -> None:
+        self.execute('PRAGMA optimize')
 
 
 class UnknownFilesTracker(BaseModel):
@@ -406,6 +1614,63 @@ class Hasher:
         raise AppError(f'Unhandled hash identifier {identifier}')
 
 
+class VerifiedFile(BaseModel):
+    size: int
+    mtime_ns: int
+    inode: int
+    algorithm: str
+    digest: str
+
+
+class VerificationLedger(BaseModel):
+    DEFAULT_FILE_NAME: ClassVar[str] = 'verified.json'
+
+    files: dict[str, VerifiedFile] = Field(default_factory=dict)
+    _recorded: set[str] = PrivateAttr(default_factory=set)
+
+    @classmethod
+    def load(cls, directory: Path) -> Self:
+        file = directory / cls.DEFAULT_FILE_NAME
+        try:
+            return cls.parse_file(file)
+        except FileNotFoundError:
+            return cls()
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring unreadable verification ledger {file}: {e}')
+            return cls()
+
+    def get_digest(self, file: Path, algorithm: str) -> str | None:
+        entry = self.files.get(file.as_posix())
+        if entry is None or entry.algorithm != algorithm:
+            return None
+        try:
+            stat = file.stat()
+        except OSError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns, stat.st_ino) != (entry.size, entry.mtime_ns, entry.inode):
+            logging.debug(f'File {file} changed since its last verification')
+            return None
+        return entry.digest
+
+    def record(self, file: Path, algorithm: str, digest: str) -> None:
+        stat = file.stat()
+        self.files[file.as_posix()] = VerifiedFile(size=stat.st_size, mtime_ns=stat.st_mtime_ns, inode=stat.st_ino,
+                                                   algorithm=algorithm, digest=digest)
+        self._recorded.add(file.as_posix())
+
+    def write(self, directory: Path) -> Path:
+        target = directory / self.DEFAULT_FILE_NAME
+        logging.info(f'Writing verification ledger to {target}')
+        # only keep files verified during this run, others are not part of the configuration anymore
+        recorded = {file: self.files[file] for file in sorted(self._recorded)}
+        try:
+            with open(target, 'wt') as f:
+                f.write(VerificationLedger(files=recorded).json(indent=4))
+        except OSError as e:
+            raise AppError(f'Failed to write verification ledger {target}: {e}')
+        return target
+
+
 class ProductReleaseOs(BaseModel):
     archive: str
     hash: str
@@ -421,6 +1686,15 @@ class ProductsIndex(BaseModel):
 
     products: dict[str, ProductInfo] = Field(default_factory=dict)
 
+    @classmethod
+    def load(cls, directory: Path) -> Self:
+        file = directory / cls.DEFAULT_FILE_NAME
+        logging.info(f'Loading metadata : {file}')
+        try:
+            return cls.parse_file(file)
+        except (OSError, ValueError) as e:
+            raise AppError(f'Could not load metadata {file}: {e}')
+
     def write(self, directory: Path) -> Path:
         file = directory / self.DEFAULT_FILE_NAME
         logging.info(f'Generating metadata : {file}')
@@ -432,6 +1706,78 @@ class ProductsIndex(BaseModel):
         return file
 
 
+class RunState(BaseModel):
+    DEFAULT_FILE_NAME: ClassVar[str] = 'state.json'
+
+    fingerprint: str | None = None
+    index_digest: str | None = None
+
+    @classmethod
+    def load(cls, directory: Path) -> Self:
+        file = directory / cls.DEFAULT_FILE_NAME
+        try:
+            return cls.parse_file(file)
+        except FileNotFoundError:
+            return cls()
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring unreadable run state {file}: {e}')
+            return cls()
+
+    def write(self, directory: Path) -> Path:
+        target = directory / self.DEFAULT_FILE_NAME
+        logging.info(f'Writing run state to {target}')
+        try:
+            with open(target, 'wt') as f:
+                f.write(self.json(indent=4))
+        except OSError as e:
+            raise AppError(f'Failed to write run state {target}: {e}')
+        return target
+
+
+class LockedArchive(BaseModel):
+    url: str | None = None
+    checksum_url: str | None = None
+    digest: str
+
+
+class LockedPluginUpdate(JBPluginUpdate):
+    url: str | None = None
+
+
+class LockedProduct(BaseModel):
+    name: str
+    release: JBProductRelease
+    archives: dict[str, LockedArchive] = Field(default_factory=dict)
+    plugins: dict[int, int | None] = Field(default_factory=dict)
+
+
+class ConfigLock(BaseModel):
+    SUFFIX: ClassVar[str] = '.lock'
+
+    config_digest: str
+    products: dict[str, LockedProduct] = Field(default_factory=dict)
+    plugins: dict[int, JBPlugin] = Field(default_factory=dict)
+    updates: dict[int, LockedPluginUpdate] = Field(default_factory=dict)
+
+    @classmethod
+    def load(cls, file: Path) -> Self:
+        logging.info(f'Loading lock file : {file}')
+        try:
+            return cls.parse_file(file)
+        except (OSError, ValueError) as e:
+            raise AppError(f'Could not load lock file {file}: {e}')
+
+    def write(self, file: Path) -> Path:
+        logging.info(f'Writing lock file : {file}')
+        try:
+            with open(file, 'wt') as f:
+                # aliases are kept so that models can be loaded back from their original field names
+                f.write(self.json(indent=4, by_alias=True))
+        except OSError as e:
+            raise AppError(f'Could not write lock file {file}: {e}')
+        return file
+
+
 class Store(BaseModel):
     ARTEFACTS_DESTINATION: ClassVar[str] = 'artefacts'
     PRODUCTS_DESTINATION: ClassVar[str] = 'products'
@@ -465,9 +1811,27 @@ class App:
         self.config = Config.load(self.args.config)
         self.store = Store(destination=self.args.dest)
         self.plugins: dict[int, JBPlugin] = {}
-        self.plugins_updates: dict[int, list[JBPluginUpdate]] = {}
-        self.cache = DiskCache() if self.args.cache_api else NoCache()
-        self.api = JetBrainsApi(cache=self.cache, tracker=UrlTracker())
+        self.plugins_updates: dict[int, PluginUpdateTable] = {}
+        self.compatibility: dict[str, dict[int, JBPluginUpdate | None]] = {}
+        self.releases: dict[str, JBProductRelease] = {}
+        self.products: dict[str, JBProduct] = {}
+        self.fingerprint: str | None = None
+        self.lock_file = Path(self.args.config).with_suffix(ConfigLock.SUFFIX)
+        self.cache = self.get_cache_backend()
+        if not isinstance(self.cache, NoCache):
+            # parsed models are kept in memory above the persistent cache, for the duration of the run
+            self.cache = MemoryCache(self.cache, is_kept=JetBrainsApi.is_kept_in_memory)
+        self.api = JetBrainsApi(cache=self.cache, tracker=UrlTracker(),
+                                redirects=RedirectMap.load(self.store.metadata_dir()),
+                                segments=self.args.segments,
+                                segment_threshold=self.args.segment_threshold * 1024 * 1024,
+                                pool_size=max(DEFAULT_POOLSIZE, self.args.jobs * self.args.segments),
+                                host_limit=self.args.host_jobs,
+                                cache_models=self.args.cache_models,
+                                host_pools=dict(self.args.host_pool),
+                                known_hosts=UrlTracker.load_hostnames(self.store.metadata_dir()),
+                                retry_policy=RetryPolicy(self.args.retries, self.args.retry_budget))
+        self.ledger = VerificationLedger.load(self.store.metadata_dir())
         self.unknown_file_tracker = UnknownFilesTracker()
         self.known_files: set[Path] = set()
         self.products_index = ProductsIndex()
@@ -479,31 +1843,65 @@ class App:
         parser.add_argument('-v', '--verbose', action='store_true')
         parser.add_argument('-c', '--config', default=Config.DEFAULT_FILE_NAME)
         parser.add_argument('-d', '--dest', default='.')
+        parser.add_argument('-j', '--jobs', type=positive_int, default=4)
+        parser.add_argument('--host-jobs', type=positive_int, default=4)
+        parser.add_argument('--host-pool', type=host_pool, action='append', default=[], metavar='HOST=SIZE')
+        parser.add_argument('--retries', type=non_negative_int, default=3)
+        parser.add_argument('--retry-budget', type=positive_int, default=20)
+        parser.add_argument('--segments', type=positive_int, default=4)
+        parser.add_argument('--segment-threshold', type=positive_int, default=64, metavar='MB')
+        parser.add_argument('--reverify', action='store_true')
+        parser.add_argument('--verify-only', action='store_true')
+        parser.add_argument('--locked', action='store_true')
         parser.add_argument('--cache-api', action='store_true')
+        parser.add_argument('--cache-models', action='store_true')
+        parser.add_argument('--cache-backend', choices=['disk', 'sqlite'], default='disk')
+        parser.add_argument('--cache-max-entries', type=positive_int, default=10000)
+        parser.add_argument('--cache-max-size', type=positive_int, default=256, metavar='MB')
+        parser.add_argument('--cache-gc', action='store_true')
         parser.add_argument(self.OPTION_CLEAN_UNKNOWN, action='store_true')
         return parser.parse_args(argv)
 
+    def get_cache_backend(self) -> Cache:
+        if not self.args.cache_api and not self.args.cache_gc:
+            return NoCache()
+        if self.args.cache_backend == 'sqlite':
+            return SqliteCache(max_entries=self.args.cache_max_entries, max_size=self.args.cache_max_size * 1024 * 1024)
+        return DiskCache(max_entries=self.args.cache_max_entries, max_size=self.args.cache_max_size * 1024 * 1024)
+
     @staticmethod
     def get_product_release(product: JBProduct, version: str = None) -> JBProductRelease | None:
         if version is None:
             release = product.get_latest_release()
         else:
-            release = product.get_release(version)
+            # a product may be pinned either by version or by build
+            release = product.get_release(version) or product.get_release_by_build(version)
         if release is None:
             raise AppError(f'Version not found for {product.name}')
         return release
 
-    def download_product_release_os_archive(self, link: str, os_dir: Path, size: int):
-        file = self.api.download_file(link, os_dir)
+    def download_product_release_os_archive(self, link: str, os_dir: Path, size: int, algorithm: str):
+        file = self.api.download_file(link, os_dir, size=size, algorithm=algorithm)
         if file.stat().st_size != size:
             file.unlink()
             raise AppError(f'Downloaded {file} has the wrong size, and was removed')
         self.known_files.add(file)
         return file
 
+    def is_archive_valid(self, archive_file: Path, hash_file: Path, computed: str | None) -> bool:
+        algorithm = get_digest_algorithm(hash_file.name)
+        if computed is None and not self.args.reverify:
+            # unchanged files verified during a previous run do not need to be read again
+            computed = self.ledger.get_digest(archive_file, algorithm)
+        if not is_digest_valid(archive_file, hash_file, computed):
+            return False
+        self.ledger.record(archive_file, algorithm, get_hash_file_digest(hash_file))
+        return True
+
     def download_product_release_os_hash(self, link: str, os_dir: Path, archive_file: Path):
         file = self.api.download_file(link, os_dir)
-        if not is_digest_valid(archive_file, file):
+        computed = self.api.streamed_digests.pop(archive_file, None)
+        if not self.is_archive_valid(archive_file, file, computed):
             archive_file.unlink()
             raise AppError(f'Downloaded {archive_file} has the wrong hash, and was removed')
         logging.info(f'Valid {archive_file.name} found on disk')
@@ -513,7 +1911,8 @@ class App:
     def download_product_release_os(self, info: JBProductReleaseDownloadInfo, id_os: str) -> ProductReleaseOs:
         os_dir = self.store.products_dir() / id_os
         self.known_files.add(os_dir)
-        archive_file = self.download_product_release_os_archive(info.link, os_dir, info.size)
+        algorithm = get_digest_algorithm(urlparse(info.checksum_link).path)
+        archive_file = self.download_product_release_os_archive(info.link, os_dir, info.size, algorithm)
         hash_file = self.download_product_release_os_hash(info.checksum_link, os_dir, archive_file)
         return ProductReleaseOs(archive=self.store.relative_posix(archive_file),
                                 hash=self.store.relative_posix(hash_file))
@@ -525,61 +1924,217 @@ class App:
         except AttributeError:
             raise AppError(f'Unknown OS {id_os}')
 
-    def download_product_release(self, release: JBProductRelease, config_os: list[str]) -> dict[str, ProductReleaseOs]:
+    def download_product_release(self, executor: Executor, release: JBProductRelease,
+                                 config_os: list[str]) -> dict[str, Future[ProductReleaseOs]]:
         os_releases = {}
         for id_os in config_os:
             info = self.get_release_download_info(release.downloads, id_os)
-            os_releases[id_os] = self.download_product_release_os(info, id_os)
+            os_releases[id_os] = executor.submit(self.download_product_release_os, info, id_os)
         return os_releases
 
-    def download_product(self, _id: str, config: ProductConfig) -> tuple[str, dict[str, ProductReleaseOs]]:
-        product = self.api.get_product(_id)
+    def get_configured_product_release(self, _id: str, product: JBProduct, config: ProductConfig) -> JBProductRelease:
         release = self.get_product_release(product, config.version)
         logging.info(f'Product {_id} is "{product.name}", and version {release.version} is build {release.build}')
-        os_releases = self.download_product_release(release, config.os)
-        return release.build, os_releases
-
-    def is_plugin_update_compatible_with(self, update: JBPluginUpdate, product_tuple: tuple[int, ...]) -> bool:
-        since = self.api.get_build_tuple(update.since)
-        until = self.api.get_build_tuple(update.until)
-        return self.api.is_build_between(since, product_tuple, until)
-
-    def find_compatible_plugin_update(self, updates: list[JBPluginUpdate], product_build: str) -> JBPluginUpdate | None:
-        product_tuple = self.api.get_build_tuple(product_build)
-        for update in updates:
-            if self.is_plugin_update_compatible_with(update, product_tuple):
-                return update
-        return None
-
-    def download_plugin(self, plugin: JBPlugin, product_build: str) -> str | None:
-        compatible = self.find_compatible_plugin_update(self.plugins_updates[plugin.id], product_build)
-        if compatible is None:
-            logging.warning(f'No matching plugin {plugin.name} version for product build {product_build}')
-            return None
-        logging.info(f'Plugin {plugin.name} version {compatible.version} matches {product_build}')
-        file = self.api.download_plugin(compatible.id, self.store.plugins_dir())
-        self.known_files.add(file)
-        return self.store.relative_posix(file)
+        return release
 
-    def download_plugins(self, product_build: str) -> dict[int, str | None]:
-        conf_plugins = (self.plugins[pid] for pid in self.config.plugins)
+    def resolve_plugins(self, product_build: str) -> dict[int, JBPluginUpdate | None]:
+        compatible = self.compatibility[product_build]
+        for plugin in (self.plugins[pid] for pid in self.config.plugins):
+            update = compatible[plugin.id]
+            if update is None:
+                logging.warning(f'No matching plugin {plugin.name} version for product build {product_build}')
+            else:
+                logging.info(f'Plugin {plugin.name} version {update.version} matches {product_build}')
         # keep plugins for which a compatible version has not been found to notify preserve their incompatibility
-        return {plugin.id: self.download_plugin(plugin, product_build) for plugin in conf_plugins}
+        return {pid: compatible[pid] for pid in self.config.plugins}
 
-    def process_configured_product(self, product_id: str, product_config: ProductConfig) -> None:
-        build_id, os_releases = self.download_product(product_id, product_config)
-        plugin_files = self.download_plugins(build_id)
-        self.products_index.products[product_id] = ProductInfo(archives=os_releases, plugins=plugin_files)
+    def download_plugin(self, update: JBPluginUpdate) -> str:
+        file = self.api.download_plugin(update.id, self.store.plugins_dir())
+        self.known_files.add(file)
+        return self.store.relative_posix(file)
+
+    @staticmethod
+    def get_results(futures: dict[Any, Future]) -> dict:
+        return {key: future.result() for key, future in futures.items()}
 
     def process_configured_products(self) -> None:
-        for product_id, product_config in self.config.products.items():
-            logging.info(f'Processing {product_id}')
-            self.process_configured_product(product_id, product_config)
+        executor = ThreadPoolExecutor(max_workers=self.args.jobs)
+        try:
+            archives, plugins = {}, {}
+            for product_id, product_config in self.config.products.items():
+                logging.info(f'Processing {product_id}')
+                release = self.releases[product_id]
+                archives[product_id] = self.download_product_release(executor, release, product_config.os)
+                plugins[product_id] = self.resolve_plugins(release.build)
+            # products often share plugin updates, each of them is only downloaded once
+            updates = {update.id: update for resolved in plugins.values() for update in resolved.values()
+                       if update is not None}
+            files = {update_id: executor.submit(self.download_plugin, update) for update_id, update in updates.items()}
+            # results are gathered in configuration order, whatever the completion order
+            for product_id in self.config.products:
+                plugin_files = {pid: None if update is None else files[update.id].result()
+                                for pid, update in plugins[product_id].items()}
+                self.products_index.products[product_id] = ProductInfo(archives=self.get_results(archives[product_id]),
+                                                                       plugins=plugin_files)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def load_plugin_updates(self, plugin_id: int, builds: set[str]) -> PluginUpdateTable:
+        # updates are received newest first and the first compatible one is selected,
+        # so no further page is needed once every product build has found its match
+        unmatched = {build: self.api.get_build_tuple(build) for build in builds}
+        updates = PluginUpdateTable()
+        for update in self.api.iter_plugin_updates(plugin_id) if unmatched else ():
+            updates.append(update)
+            interval = updates.intervals[-1]
+            unmatched = {build: product_tuple for build, product_tuple in unmatched.items()
+                         if not PluginCompatibilityIndex.is_within(interval, product_tuple)}
+            if not unmatched:
+                logging.info(f'Found {len(updates)} releases for plugin id {plugin_id} to match every product')
+                return updates
+        logging.info(f'Found {len(updates)} releases for plugin id {plugin_id}')
+        return updates
 
-    def load_configured_plugins_information(self):
-        self.plugins = {pid: self.api.get_plugin(pid) for pid in self.config.plugins}
-        logging.info(f'Found {len(self.plugins)} plugins in configuration')
-        self.plugins_updates = {pid: self.api.get_plugin_updates_all(pid) for pid in self.config.plugins}
+    def get_latest_plugin_update_id(self, plugin_id: int) -> int | None:
+        updates = self.api.get_plugin_updates(plugin_id, 0, 1)
+        return updates[0].id if updates else None
+
+    def get_fingerprint(self, latest_updates: dict[int, int | None]) -> str:
+        h = hashlib.sha256(self.get_config_digest().encode())
+        for product_id in self.config.products:
+            h.update(self.products[product_id].json().encode())
+        for plugin_id in self.config.plugins:
+            h.update(self.plugins[plugin_id].json().encode())
+            h.update(str(latest_updates[plugin_id]).encode())
+        return h.hexdigest()
+
+    def load_configured_products(self):
+        executor = ThreadPoolExecutor(max_workers=self.args.jobs)
+        try:
+            # plugin information does not depend on products, so both are requested at once
+            versions = {product_id: config.version for product_id, config in self.config.products.items()}
+            products = executor.submit(self.api.get_products, versions)
+            plugins = {pid: executor.submit(self.api.get_plugin, pid) for pid in self.config.plugins}
+            # the newest update of each plugin is enough to notice a new release, without loading every page
+            latest_updates = {pid: executor.submit(self.get_latest_plugin_update_id, pid)
+                              for pid in self.config.plugins}
+            self.products = products.result()
+            self.releases = {_id: self.get_configured_product_release(_id, self.products[_id], config)
+                             for _id, config in self.config.products.items()}
+            self.plugins = self.get_results(plugins)
+            logging.info(f'Found {len(self.plugins)} plugins in configuration')
+            self.fingerprint = self.get_fingerprint(self.get_results(latest_updates))
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def load_configured_information(self):
+        executor = ThreadPoolExecutor(max_workers=self.args.jobs)
+        try:
+            builds = {release.build for release in self.releases.values()}
+            updates = {pid: executor.submit(self.load_plugin_updates, pid, builds) for pid in self.config.plugins}
+            self.plugins_updates = self.get_results(updates)
+            # every product build is resolved against every plugin update at once
+            self.compatibility = CompatibilityResolver.resolve(sorted(builds), self.plugins_updates)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def get_config_digest(self) -> str:
+        return get_file_digest(Path(self.args.config), 'sha256')
+
+    def load_locked_information(self):
+        lock = ConfigLock.load(self.lock_file)
+        if lock.config_digest != self.get_config_digest():
+            raise AppError(f'Lock file {self.lock_file} does not match {self.args.config}, restart without --locked')
+        self.plugins = lock.plugins
+        for product_id, locked in lock.products.items():
+            self.products[product_id] = JBProduct(code=product_id, name=locked.name, releases=[locked.release])
+            release = self.get_configured_product_release(product_id, self.products[product_id],
+                                                          self.config.products[product_id])
+            self.releases[product_id] = release
+            self.compatibility[release.build] = {pid: None if update_id is None else lock.updates[update_id]
+                                                 for pid, update_id in locked.plugins.items()}
+            # known final urls allow to skip any request for files already on disk
+            for id_os, archive in locked.archives.items():
+                info = self.get_release_download_info(release.downloads, id_os)
+                for url, final_url in ((info.link, archive.url), (info.checksum_link, archive.checksum_url)):
+                    if final_url is not None:
+                        self.api.redirects.record(Request('GET', url).prepare().url, final_url)
+        for update in lock.updates.values():
+            if update.url is not None:
+                self.api.redirects.record(self.api.get_plugin_download_url(update.id), update.url)
+
+    def get_lock(self) -> ConfigLock:
+        lock = ConfigLock(config_digest=self.get_config_digest(), plugins=self.plugins)
+        for product_id, release in self.releases.items():
+            locked = LockedProduct(name=self.products[product_id].name, release=release)
+            for id_os, item in self.products_index.products[product_id].archives.items():
+                info = self.get_release_download_info(release.downloads, id_os)
+                locked.archives[id_os] = LockedArchive(url=self.api.get_recorded_url(info.link),
+                                                       checksum_url=self.api.get_recorded_url(info.checksum_link),
+                                                       digest=get_hash_file_digest(self.store.destination / item.hash))
+            for pid, update in self.compatibility[release.build].items():
+                locked.plugins[pid] = None if update is None else update.id
+                if update is not None:
+                    url = self.api.get_recorded_url(self.api.get_plugin_download_url(update.id))
+                    lock.updates[update.id] = LockedPluginUpdate(**{**update.dict(by_alias=True), 'url': url})
+            lock.products[product_id] = locked
+        return lock
+
+    def manage_lock(self):
+        if not self.args.locked:
+            self.get_lock().write(self.lock_file)
+            return
+        # hash files already on disk are not requested again, so only the mirror is checked against the lock,
+        # an archive changed upstream after it was mirrored is not detected
+        expected = ConfigLock.load(self.lock_file)
+        for product_id, locked in self.get_lock().products.items():
+            for id_os, archive in locked.archives.items():
+                if archive.digest != expected.products[product_id].archives[id_os].digest:
+                    raise AppError(f'Digest of {product_id} for {id_os} differs from lock file {self.lock_file}')
+
+    def get_missing_files(self, index: ProductsIndex) -> list[Path]:
+        files = []
+        for product in index.products.values():
+            files.extend(self.store.destination / item.archive for item in product.archives.values())
+            files.extend(self.store.destination / item.hash for item in product.archives.values())
+            files.extend(self.store.destination / path for path in product.plugins.values() if path is not None)
+        # plugins shared by several products are only checked once
+        return [file for file in dict.fromkeys(files) if not file.is_file()]
+
+    def is_unchanged(self) -> bool:
+        # a forced verification or a cleanup of unknown files always needs the full run
+        if self.args.reverify or self.args.clean_unknown:
+            return False
+        state = RunState.load(self.store.metadata_dir())
+        if state.fingerprint is None or state.fingerprint != self.fingerprint:
+            return False
+        index_file = self.store.metadata_dir() / ProductsIndex.DEFAULT_FILE_NAME
+        try:
+            if get_file_digest(index_file, 'sha256') != state.index_digest:
+                return False
+            index = ProductsIndex.parse_file(index_file)
+        except (AppError, ValueError) as e:
+            logging.debug(f'Index is not usable for the fast path: {e}')
+            return False
+        missing = self.get_missing_files(index)
+        if missing:
+            logging.info(f'Found {len(missing)} missing files since last run, e.g. {missing[0]}')
+            return False
+        return True
+
+    def manage_state(self):
+        if self.fingerprint is None:
+            # locked runs keep the state of the last unlocked run
+            self.known_files.add(self.store.metadata_dir() / RunState.DEFAULT_FILE_NAME)
+            return
+        index_file = self.store.metadata_dir() / ProductsIndex.DEFAULT_FILE_NAME
+        state = RunState(fingerprint=self.fingerprint, index_digest=get_file_digest(index_file, 'sha256'))
+        file = state.write(self.store.metadata_dir())
+        self.known_files.add(file)
+
+    def log_connection_statistics(self) -> None:
+        for hostname, (connections, requests) in sorted(self.api.get_connection_statistics().items()):
+            logging.info(f'Host {hostname} : {requests} requests over {connections} connections')
 
     def manage_unknown_files(self) -> None:
         logging.info(f'Found {len(self.known_files)} files linked to the configuration')
@@ -603,6 +2158,23 @@ class App:
         file = self.api.url_tracker.write_tracked_url(self.store.metadata_dir())
         self.known_files.add(file)
 
+    def manage_compatibility(self):
+        matrix = CompatibilityMatrix()
+        for product_id, release in self.releases.items():
+            plugins = {pid: None if update is None else update.version
+                       for pid, update in self.compatibility[release.build].items()}
+            matrix.products[product_id] = ProductCompatibility(build=release.build, plugins=plugins)
+        file = matrix.write(self.store.metadata_dir())
+        self.known_files.add(file)
+
+    def manage_ledger(self):
+        file = self.ledger.write(self.store.metadata_dir())
+        self.known_files.add(file)
+
+    def manage_redirects(self):
+        file = self.api.redirects.write(self.store.metadata_dir())
+        self.known_files.add(file)
+
     def reset(self):
         self.products_index.products.clear()
         self.known_files.clear()
@@ -611,13 +2183,70 @@ class App:
         self.known_files.add(self.store.plugins_dir())
         self.known_files.add(self.store.metadata_dir())
 
+    def verify_archives(self) -> None:
+        index = ProductsIndex.load(self.store.metadata_dir())
+        archives = {(self.store.destination / item.archive, self.store.destination / item.hash)
+                    for product in index.products.values() for item in product.archives.values()}
+        logging.info(f'Verifying {len(archives)} archives...')
+        invalid = 0
+        # hashing is cpu bound, so it is spread over processes rather than threads
+        with ProcessPoolExecutor() as executor:
+            futures = {}
+            for archive_file, hash_file in sorted(archives):
+                algorithm = get_digest_algorithm(hash_file.name)
+                futures[archive_file, hash_file, algorithm] = executor.submit(get_file_digest, archive_file, algorithm)
+            for (archive_file, hash_file, algorithm), future in futures.items():
+                try:
+                    expected = get_hash_file_digest(hash_file)
+                    valid = future.result() == expected
+                except AppError as e:
+                    logging.error(e)
+                    valid = False
+                if valid:
+                    logging.info(f'Valid {archive_file.name} found on disk')
+                    self.ledger.record(archive_file, algorithm, expected)
+                else:
+                    logging.error(f'Archive {archive_file} does not match {hash_file.name}')
+                    invalid += 1
+        self.ledger.write(self.store.metadata_dir())
+        if invalid > 0:
+            raise AppError(f'Found {invalid} invalid archives out of {len(archives)}')
+        logging.info(f'All {len(archives)} archives are valid')
+
     def main(self):
+        if self.args.verify_only:
+            self.verify_archives()
+            return
+        if self.args.cache_gc:
+            self.cache.collect()
+            return
+        try:
+            self.download()
+        finally:
+            # accesses are recorded even for failed runs, so that the cache eviction stays accurate
+            self.cache.flush()
+            self.log_connection_statistics()
+
+    def download(self):
         logging.info('Starting JetBrains product and plugins downloader...')
         self.reset()
-        self.load_configured_plugins_information()
+        if self.args.locked:
+            self.load_locked_information()
+        else:
+            self.load_configured_products()
+            if self.is_unchanged():
+                logging.info('Configuration, metadata and index are unchanged since last run, nothing to download')
+                return
+            self.load_configured_information()
         self.process_configured_products()
+        self.manage_lock()
         self.manage_metadata()
+        self.manage_compatibility()
         self.manage_url_tracker()
+        self.manage_redirects()
+        self.manage_ledger()
+        # the run state is only written once every file is in place, an interrupted run is never skipped
+        self.manage_state()
         self.manage_unknown_files()
         logging.info('JetBrains product and plugins downloader finished.')
 